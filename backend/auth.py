@@ -1,7 +1,10 @@
 from passlib.context import CryptContext
+from cachetools import TTLCache
 from datetime import datetime, timedelta
+import hashlib
 import jwt
 import os
+import threading
 from typing import Optional
 
 # Security Configuration
@@ -15,6 +18,26 @@ pwd_context = CryptContext(schemes=["argon2"], deprecated="auto")
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
 
+# Recent successful logins, keyed by (user id, password digest, stored hash).
+# Only repeated logins within the TTL skip argon2; any other attempt still pays
+# the full hashing cost. Including the stored hash invalidates entries when the
+# password changes.
+_verified_logins = TTLCache(maxsize=1024, ttl=60)
+_verified_logins_lock = threading.Lock()
+
+def verify_password_cached(user_id: int, plain_password: str, hashed_password: str) -> bool:
+    key = (user_id, hashlib.sha256(plain_password.encode()).digest(), hashed_password)
+    with _verified_logins_lock:
+        if key in _verified_logins:
+            return True
+
+    if not verify_password(plain_password, hashed_password):
+        return False
+
+    with _verified_logins_lock:
+        _verified_logins[key] = True
+    return True
+
 def get_password_hash(password):
     return pwd_context.hash(password)
 
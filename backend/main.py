@@ -1,21 +1,29 @@
 from fastapi import FastAPI, Depends, HTTPException, Header, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from cachetools import TTLCache
 from sqlmodel import SQLModel, Session, select, create_engine
-from typing import List, Optional
+from sqlalchemy import case, event, insert, or_, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import selectinload, contains_eager
+from typing import List, Literal, Optional
 from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
-from pydantic import BaseModel
+from pydantic import BaseModel, constr
+import hashlib
+import json
 import os
+import threading
 
 # Import relative to the package if running as a module, but for simplicity assuming execution from root
 # We will use relative imports assuming `uvicorn backend.main:app`
-from models import Song, LyricsLine, VocabCard, User
+from models import Song, LyricsLine, VocabCard, User, AnalysisCache
 
 # Make sure to import `analyze_lyrics_with_gemini`
 from gemini_service import analyze_lyrics_with_gemini
 
 # Import Auth functions
-from auth import verify_password, get_password_hash, create_access_token, decode_access_token, ACCESS_TOKEN_EXPIRE_MINUTES
+from auth import verify_password_cached, get_password_hash, create_access_token, decode_access_token, ACCESS_TOKEN_EXPIRE_MINUTES
 
 # Database Setup
 DATABASE_URL = os.getenv("DATABASE_URL")
@@ -24,10 +32,43 @@ if not DATABASE_URL:
     sqlite_file_name = os.getenv("SQLITE_DB_PATH", "database.db")
     DATABASE_URL = f"sqlite:///{sqlite_file_name}"
     connect_args = {"check_same_thread": False}
+    # SQLAlchemy already keeps file-based SQLite connections open in a QueuePool,
+    # so the PRAGMAs below are applied once per pooled connection.
+    pool_args = {}
 else:
     connect_args = {}
+    # Sized for the async analyze endpoint's higher in-flight request count;
+    # pre_ping/recycle replace connections dropped by the managed Postgres while idle.
+    pool_args = {
+        "pool_size": int(os.getenv("DB_POOL_SIZE", 20)),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", 40)),
+        "pool_pre_ping": True,
+        "pool_recycle": 1800,
+    }
+
+engine = create_engine(DATABASE_URL, connect_args=connect_args, **pool_args)
+
+# SQLite tuning: WAL lets readers proceed while a write is in progress and,
+# with synchronous=NORMAL, avoids an fsync on every commit.
+SQLITE_PRAGMAS = (
+    "journal_mode=WAL",
+    "synchronous=NORMAL",
+    "temp_store=MEMORY",
+    "mmap_size=268435456",
+    "cache_size=-65536",
+    "foreign_keys=ON",
+)
+
+if engine.dialect.name == "sqlite":
+    @event.listens_for(engine, "connect")
+    def _set_sqlite_pragma(dbapi_connection, _connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in SQLITE_PRAGMAS:
+            cursor.execute(f"PRAGMA {pragma}")
+        cursor.close()
 
-engine = create_engine(DATABASE_URL, connect_args=connect_args)
+# INSERT ... ON CONFLICT DO NOTHING is dialect-specific (SQLite and Postgres both support it)
+dialect_insert = postgresql.insert if engine.dialect.name == "postgresql" else sqlite.insert
 
 def create_db_and_tables():
     SQLModel.metadata.create_all(engine)
@@ -36,9 +77,13 @@ def get_session():
     with Session(engine) as session:
         yield session
 
+# Set AUTO_CREATE_TABLES=0 in production and run `python migrate.py` on deploy instead
+AUTO_CREATE_TABLES = os.getenv("AUTO_CREATE_TABLES", "1") == "1"
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    create_db_and_tables()
+    if AUTO_CREATE_TABLES:
+        create_db_and_tables()
     yield
 
 app = FastAPI(lifespan=lifespan)
@@ -67,6 +112,37 @@ class TokenResponse(BaseModel):
     token: str
     username: str
 
+# Authenticated users by id, so most requests skip the User query.
+# Entries are detached copies (never added back to a session) and are dropped
+# when the user's rate-limit counter is written.
+_user_cache = TTLCache(maxsize=10_000, ttl=30)
+_user_cache_lock = threading.Lock()
+
+def _get_user_by_id(session: Session, user_id: int) -> Optional[User]:
+    with _user_cache_lock:
+        cached = _user_cache.get(user_id)
+    if cached is not None:
+        return cached
+
+    user = session.get(User, user_id)
+    if user is None:
+        return None
+    # Copy column fields only; relationships (e.g. `songs`) must not be loaded or cached
+    user = User(**user.model_dump())
+    with _user_cache_lock:
+        _user_cache[user_id] = user
+    return user
+
+def _invalidate_cached_user(user_id: int):
+    with _user_cache_lock:
+        _user_cache.pop(user_id, None)
+
+def _create_user_token(user: User) -> str:
+    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    return create_access_token(
+        data={"sub": str(user.id), "username": user.username}, expires_delta=access_token_expires
+    )
+
 # Dependency to verify token and get current user
 def get_current_user(x_auth_token: str = Header(..., alias="x-auth-token"), session: Session = Depends(get_session)):
     payload = decode_access_token(x_auth_token)
@@ -75,15 +151,19 @@ def get_current_user(x_auth_token: str = Header(..., alias="x-auth-token"), sess
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid or expired token",
         )
-    username: str = payload.get("sub")
-    if username is None:
+    subject: str = payload.get("sub")
+    if subject is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid token payload",
         )
     
     # Optional: Verify user still exists in DB
-    user = session.exec(select(User).where(User.username == username)).first()
+    if "username" in payload:
+        user = _get_user_by_id(session, int(subject))
+    else:
+        # Tokens issued before the switch to id subjects carry the username in `sub`
+        user = session.exec(select(User).where(User.username == subject)).first()
     if user is None:
         raise HTTPException(status_code=401, detail="User not found")
         
@@ -106,35 +186,34 @@ def register(creds: AuthRequest, session: Session = Depends(get_session)):
     session.refresh(new_user)
     
     # Create Token
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(
-        data={"sub": new_user.username}, expires_delta=access_token_expires
-    )
+    access_token = _create_user_token(new_user)
     
     return {"token": access_token, "username": new_user.username}
 
 @app.post("/api/login", response_model=TokenResponse)
 def login(creds: AuthRequest, session: Session = Depends(get_session)):
     user = session.exec(select(User).where(User.username == creds.username)).first()
-    if not user or not verify_password(creds.password, user.password_hash):
+    if not user or not verify_password_cached(user.id, creds.password, user.password_hash):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
         )
     
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(
-        data={"sub": user.username}, expires_delta=access_token_expires
-    )
+    access_token = _create_user_token(user)
     return {"token": access_token, "username": user.username}
 
 # ---------------------------
 
 
 # Request Models
+# Bounds on submitted lyrics, checked before any Gemini quota is spent.
+# The character cap matches the frontend's MAX_CHARS.
+MAX_LYRICS_LENGTH = 2000
+MAX_LYRICS_LINES = 200
+
 class AnalyzeRequest(BaseModel):
-    lyrics: str
-    language: str
+    lyrics: constr(strip_whitespace=True, min_length=1, max_length=MAX_LYRICS_LENGTH)
+    language: Literal["", "ja", "en", "ko", "zh", "fr", "es", "de"]  # "" = auto-detect
     title: Optional[str] = None
     artist: Optional[str] = None
 
@@ -166,6 +245,13 @@ class SongRead(SQLModel):
     lines: List[LyricsLineRead] = []
     vocab_cards: List[VocabCardRead] = []
 
+class SongSummary(SQLModel):
+    id: int
+    title: str
+    artist: str
+    language: str
+    created_at: datetime
+
 class SavedVocabRead(SQLModel):
     id: int
     word: str
@@ -186,53 +272,77 @@ class SavedVocabRead(SQLModel):
 # --- Rate Limiting Logic ---
 DAILY_ANALYSIS_LIMIT = int(os.getenv("DAILY_ANALYSIS_LIMIT", 5))
 
-@app.post("/api/analyze", response_model=SongRead)
-def analyze_lyrics(request: AnalyzeRequest, session: Session = Depends(get_session), user: User = Depends(get_current_user)):
+def _start_of_today() -> datetime:
+    now = datetime.utcnow()
+    return datetime(now.year, now.month, now.day)
+
+def _reserve_analysis_slot(user_id: int) -> datetime:
     """
-    Analyzes lyrics using Google Gemini, saves to DB, and returns the result.
-    Enforces a daily limit of 5 requests per user.
+    Atomically takes one of the user's daily analysis slots before Gemini is called.
+    The check and the increment are a single conditional UPDATE, so concurrent
+    requests can't all pass the limit on the same stale count.
+    Raises 429 once the daily limit has been reached; returns the start of the
+    day the slot was taken from (see `_release_analysis_slot`).
     """
-    
-    # 1. Rate Limiting Check
-    today = datetime.utcnow().date()
-    
-    if user.last_analysis_date is None or user.last_analysis_date.date() != today:
-        # Reset counter for a new day
-        user.daily_analysis_count = 0
-        user.last_analysis_date = datetime.utcnow()
-    
-    if user.daily_analysis_count >= DAILY_ANALYSIS_LIMIT:
+    today = _start_of_today()
+    is_new_day = or_(User.last_analysis_date.is_(None), User.last_analysis_date < today)
+
+    with Session(engine) as session:
+        result = session.execute(
+            update(User)
+            .where(User.id == user_id)
+            .where(or_(is_new_day, User.daily_analysis_count < DAILY_ANALYSIS_LIMIT))
+            .values(
+                # Reset counter for a new day
+                daily_analysis_count=case((is_new_day, 1), else_=User.daily_analysis_count + 1),
+                last_analysis_date=datetime.utcnow(),
+            )
+        )
+        session.commit()
+    _invalidate_cached_user(user_id)
+
+    if result.rowcount == 0:
         raise HTTPException(
             status_code=status.HTTP_429_TOO_MANY_REQUESTS,
             detail=f"Daily analysis limit of {DAILY_ANALYSIS_LIMIT} reached. Please try again tomorrow."
         )
-        
-    # Increment counter
-    user.daily_analysis_count += 1
-    user.last_analysis_date = datetime.utcnow() # Update timestamp to now
-    session.add(user)
-    session.commit()
-    session.refresh(user)
+    return today
 
-    # 2. Call Gemini Service
-    try:
-        # Note: This is a synchronous call. For high concurrency, consider making the service async 
-        # or running in a threadpool (FastAPI does this for def endpoints automatically).
-        data = analyze_lyrics_with_gemini(request.lyrics, request.language)
-    except Exception as e:
-        error_msg = str(e)
-        if "429" in error_msg or "quota" in error_msg.lower():
-            raise HTTPException(
-                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
-                detail="AI Quota Exceeded (額度不足)"
-            )
-        # Optional: Revert counter on failure if you only want to count successful attempts
-        # user.daily_analysis_count -= 1
-        # session.add(user)
-        # session.commit()
-        raise HTTPException(status_code=500, detail=f"AI Processing failed: {error_msg}")
+def _release_analysis_slot(user_id: int, reserved_day: datetime):
+    """
+    Gives back a slot taken by `_reserve_analysis_slot` when the analysis failed,
+    so only successful analyses count toward the daily limit.
+    """
+    with Session(engine) as session:
+        session.execute(
+            update(User)
+            .where(User.id == user_id)
+            .where(User.daily_analysis_count > 0)
+            .where(User.last_analysis_date >= reserved_day)
+            .values(daily_analysis_count=User.daily_analysis_count - 1)
+        )
+        session.commit()
+    _invalidate_cached_user(user_id)
+
+def _analysis_cache_key(lyrics: str, language: str) -> str:
+    return hashlib.sha256(f"{language}\x00{lyrics.strip()}".encode()).hexdigest()
 
-    # 3. Save to DB
+def _get_cached_analysis(cache_key: str, language: str) -> Optional[dict]:
+    """
+    Returns a previously stored Gemini result for the same lyrics/language, if any.
+    Uses its own short session so no connection is held while Gemini runs on a miss.
+    """
+    with Session(engine) as session:
+        cached = session.get(AnalysisCache, (cache_key, language))
+        if cached is None:
+            return None
+        return json.loads(cached.payload_json)
+
+def _save_analysis(session: Session, user: User, request: AnalyzeRequest, data: dict, cache_key: Optional[str] = None) -> Song:
+    """
+    Persists the Gemini analysis as a Song with its lines and vocab cards.
+    When `cache_key` is given, the raw result is also stored in the analysis cache.
+    """
     # Use provided title/artist if available, else use what AI found, else default
     final_title = request.title if request.title and request.title.strip() else data.get("title", "Unknown")
     final_artist = request.artist if request.artist and request.artist.strip() else data.get("artist", "Unknown")
@@ -245,58 +355,137 @@ def analyze_lyrics(request: AnalyzeRequest, session: Session = Depends(get_sessi
         user_id=user.id # Link song to current user
     )
     session.add(song)
-    session.commit()
-    session.refresh(song)
+    # Flush (not commit) so song.id is assigned inside the same transaction
+    session.flush()
     
-    # Add Lines
-    for line_data in data.get("lines", []):
-        line = LyricsLine(
-            song_id=song.id,
-            line_index=line_data.get("line_index"),
-            original_text=line_data.get("original_text"),
-            translation_text=line_data.get("translation_text"),
-            grammar_notes=line_data.get("grammar_notes", "")
-        )
-        session.add(line)
+    # Lines and vocab are bulk-inserted with Core statements: the ORM objects
+    # would never be used again, and the reload below fetches them anyway.
+    line_rows = [
+        {
+            "song_id": song.id,
+            "line_index": line_data.get("line_index"),
+            "original_text": line_data.get("original_text"),
+            "translation_text": line_data.get("translation_text"),
+            "grammar_notes": line_data.get("grammar_notes", ""),
+        }
+        for line_data in data.get("lines", [])
+    ]
+    if line_rows:
+        session.execute(insert(LyricsLine), line_rows)
         
-    # Add Vocab
-    for vocab_data in data.get("vocab", []):
-        vocab = VocabCard(
-            song_id=song.id,
-            word=vocab_data.get("word"),
-            lemma=vocab_data.get("lemma", ""),
-            reading=vocab_data.get("reading", ""),
-            meaning=vocab_data.get("meaning", ""),
-            part_of_speech=vocab_data.get("part_of_speech", ""),
-            example_sentence=vocab_data.get("example_sentence", ""),
-            example_translation=vocab_data.get("example_translation", "")
-        )
-        session.add(vocab)
+    vocab_rows = [
+        {
+            "song_id": song.id,
+            "word": vocab_data.get("word"),
+            "lemma": vocab_data.get("lemma", ""),
+            "reading": vocab_data.get("reading", ""),
+            "meaning": vocab_data.get("meaning", ""),
+            "part_of_speech": vocab_data.get("part_of_speech", ""),
+            "example_sentence": vocab_data.get("example_sentence", ""),
+            "example_translation": vocab_data.get("example_translation", ""),
+        }
+        for vocab_data in data.get("vocab", [])
+    ]
+    if vocab_rows:
+        session.execute(insert(VocabCard), vocab_rows)
     
+    if cache_key is not None:
+        # Two identical misses can race here; the first row wins and the other
+        # insert is skipped, so the cache write never fails the analysis.
+        session.execute(
+            dialect_insert(AnalysisCache)
+            .values(
+                hash=cache_key,
+                language=request.language,
+                payload_json=json.dumps(data, ensure_ascii=False)
+            )
+            .on_conflict_do_nothing()
+        )
     session.commit()
-    session.refresh(song)
     
-    return song
+    # Reload with lines/vocab eagerly so serialization doesn't lazy-load them
+    return session.exec(
+        select(Song)
+        .where(Song.id == song.id)
+        .options(selectinload(Song.lines), selectinload(Song.vocab_cards))
+    ).one()
 
-@app.get("/api/history", response_model=List[Song])
+@app.post("/api/analyze", response_model=SongRead)
+async def analyze_lyrics(request: AnalyzeRequest, session: Session = Depends(get_session), user: User = Depends(get_current_user)):
+    """
+    Analyzes lyrics using Google Gemini, saves to DB, and returns the result.
+    Enforces a daily limit of 5 requests per user; only successful analyses
+    are counted.
+
+    The Gemini call is awaited on the event loop, so it doesn't hold a worker
+    thread; the (sync) SQLModel work is pushed to the threadpool instead.
+    """
+    
+    if request.lyrics.count("\n") >= MAX_LYRICS_LINES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Lyrics are limited to {MAX_LYRICS_LINES} lines."
+        )
+
+    # 1. Reuse a cached analysis of the same lyrics (no Gemini call, no quota used)
+    cache_key = _analysis_cache_key(request.lyrics, request.language)
+    data = await run_in_threadpool(_get_cached_analysis, cache_key, request.language)
+    if data is not None:
+        return await run_in_threadpool(_save_analysis, session, user, request, data)
+
+    # 2. Rate Limiting Check
+    reserved_day = await run_in_threadpool(_reserve_analysis_slot, user.id)
+
+    # Release the request session's connection (e.g. from the user lookup in
+    # get_current_user) for the duration of the Gemini call; _save_analysis
+    # checks a connection out again when it needs one.
+    await run_in_threadpool(session.close)
+
+    try:
+        # 3. Call Gemini Service
+        try:
+            data = await analyze_lyrics_with_gemini(request.lyrics, request.language)
+        except Exception as e:
+            error_msg = str(e)
+            if "429" in error_msg or "quota" in error_msg.lower():
+                raise HTTPException(
+                    status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                    detail="AI Quota Exceeded (額度不足)"
+                )
+            raise HTTPException(status_code=500, detail=f"AI Processing failed: {error_msg}")
+
+        # 4. Save to DB
+        return await run_in_threadpool(_save_analysis, session, user, request, data, cache_key)
+    except BaseException:
+        await run_in_threadpool(_release_analysis_slot, user.id, reserved_day)
+        raise
+
+@app.get("/api/history", response_model=List[SongSummary])
 def get_history(session: Session = Depends(get_session), user: User = Depends(get_current_user)):
     """
     Returns a list of previously analyzed songs (summary only) for the current user.
     """
-    songs = session.exec(select(Song).where(Song.user_id == user.id).order_by(Song.created_at.desc())).all()
-    return songs
+    # Select only the summary columns so source_text is never loaded
+    rows = session.exec(
+        select(Song.id, Song.title, Song.artist, Song.language, Song.created_at)
+        .where(Song.user_id == user.id)
+        .order_by(Song.created_at.desc())
+    ).all()
+    return [SongSummary(**row._mapping) for row in rows]
 
 @app.get("/api/song/{song_id}", response_model=SongRead)
 def get_song(song_id: int, session: Session = Depends(get_session), user: User = Depends(get_current_user)):
     """
     Returns full details of a specific song if it belongs to the user.
     """
-    song = session.get(Song, song_id)
+    # Ownership is part of the WHERE clause; other users' songs read as not found
+    song = session.exec(
+        select(Song)
+        .where(Song.id == song_id, Song.user_id == user.id)
+        .options(selectinload(Song.lines), selectinload(Song.vocab_cards))
+    ).first()
     if not song:
         raise HTTPException(status_code=404, detail="Song not found")
-    
-    if song.user_id != user.id:
-        raise HTTPException(status_code=403, detail="Not authorized to access this song")
         
     return song
 
@@ -305,13 +494,10 @@ def delete_song(song_id: int, session: Session = Depends(get_session), user: Use
     """
     Deletes a song and its associated data if it belongs to the user.
     """
-    song = session.get(Song, song_id)
+    song = session.exec(select(Song).where(Song.id == song_id, Song.user_id == user.id)).first()
     if not song:
         raise HTTPException(status_code=404, detail="Song not found")
     
-    if song.user_id != user.id:
-        raise HTTPException(status_code=403, detail="Not authorized to delete this song")
-    
     session.delete(song)
     session.commit()
     return {"ok": True}
@@ -321,15 +507,15 @@ def toggle_save_vocab(vocab_id: int, session: Session = Depends(get_session), us
     """
     Toggles the `is_saved` status of a vocabulary card.
     """
-    vocab_card = session.get(VocabCard, vocab_id)
+    # Verify ownership through the song in the same query
+    vocab_card = session.exec(
+        select(VocabCard)
+        .join(Song)
+        .where(VocabCard.id == vocab_id, Song.user_id == user.id)
+    ).first()
     if not vocab_card:
         raise HTTPException(status_code=404, detail="VocabCard not found")
     
-    # Verify ownership through song relationship
-    song = session.get(Song, vocab_card.song_id)
-    if not song or song.user_id != user.id:
-        raise HTTPException(status_code=403, detail="Not authorized to modify this vocabulary")
-    
     vocab_card.is_saved = not vocab_card.is_saved
     session.add(vocab_card)
     session.commit()
@@ -341,33 +527,24 @@ def get_saved_vocab(session: Session = Depends(get_session), user: User = Depend
     """
     Returns a list of all saved vocabulary cards for the current user.
     """
-    saved_vocab = (
-        session.query(VocabCard, Song)
-        .join(Song, VocabCard.song_id == Song.id)
-        .filter(VocabCard.is_saved == True)
-        .filter(Song.user_id == user.id) # Filter by current user
-        .all()
-    )
+    # Song is already joined for the ownership filter; contains_eager populates
+    # VocabCard.song from that same row instead of issuing a second query.
+    saved_vocab = session.exec(
+        select(VocabCard)
+        .join(Song)
+        .where(VocabCard.is_saved == True)
+        .where(Song.user_id == user.id) # Filter by current user
+        .options(contains_eager(VocabCard.song))
+    ).all()
     
-    results = []
-    for vocab, song in saved_vocab:
-        results.append(
-            SavedVocabRead(
-                id=vocab.id,
-                word=vocab.word,
-                lemma=vocab.lemma,
-                reading=vocab.reading,
-                meaning=vocab.meaning,
-                part_of_speech=vocab.part_of_speech,
-                example_sentence=vocab.example_sentence,
-                example_translation=vocab.example_translation,
-                is_saved=vocab.is_saved,
-                song_id=song.id,
-                song_title=song.title,
-                song_artist=song.artist,
-            )
+    return [
+        SavedVocabRead(
+            **vocab.model_dump(),
+            song_title=vocab.song.title,
+            song_artist=vocab.song.artist,
         )
-    return results
+        for vocab in saved_vocab
+    ]
 
 
 @app.get("/")
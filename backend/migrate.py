@@ -0,0 +1,56 @@
+"""
+Ad-hoc schema migration for existing databases.
+
+`SQLModel.metadata.create_all` only creates missing tables (and their indexes);
+it never adds columns or indexes declared later in `models.py`. This script
+probes the live schema and adds whatever is missing, so it is safe to run on
+every deploy (use it together with AUTO_CREATE_TABLES=0):
+
+    python migrate.py
+"""
+from sqlalchemy import inspect, literal
+from sqlmodel import SQLModel
+
+from main import engine
+
+
+def add_missing_columns():
+    # The inspector reads PRAGMA table_info on SQLite and information_schema on Postgres
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    preparer = engine.dialect.identifier_preparer
+
+    with engine.begin() as conn:
+        for table in SQLModel.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                ddl = (
+                    f"ALTER TABLE {preparer.quote(table.name)} "
+                    f"ADD COLUMN {preparer.quote(column.name)} {column.type.compile(dialect=engine.dialect)}"
+                )
+                # Existing rows need a value for columns with a model default (e.g. is_saved)
+                if column.default is not None and column.default.is_scalar:
+                    default = literal(column.default.arg).compile(
+                        dialect=engine.dialect, compile_kwargs={"literal_binds": True}
+                    )
+                    ddl += f" DEFAULT {default}"
+                conn.exec_driver_sql(ddl)
+                print(f"Column added: {table.name}.{column.name}")
+
+
+def create_missing_indexes():
+    # checkfirst issues CREATE INDEX only when the index doesn't exist yet
+    for table in SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+            print(f"Index ensured: {index.name}")
+
+
+if __name__ == "__main__":
+    SQLModel.metadata.create_all(engine)
+    add_missing_columns()
+    create_missing_indexes()
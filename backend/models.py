@@ -1,4 +1,5 @@
 from sqlmodel import SQLModel, Field, Relationship
+from sqlalchemy import Index
 from typing import Optional, List
 from datetime import datetime
 
@@ -15,6 +16,10 @@ class User(SQLModel, table=True):
     songs: List["Song"] = Relationship(back_populates="user")
 
 class Song(SQLModel, table=True):
+    # History is filtered by user and ordered by created_at; the composite
+    # index also serves plain user_id lookups via its leading column.
+    __table_args__ = (Index("ix_song_user_created", "user_id", "created_at"),)
+
     id: Optional[int] = Field(default=None, primary_key=True)
     title: str = Field(default="Unknown Title")
     artist: str = Field(default="Unknown Artist")
@@ -37,7 +42,7 @@ class Song(SQLModel, table=True):
 
 class LyricsLine(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
-    song_id: int = Field(foreign_key="song.id")
+    song_id: int = Field(foreign_key="song.id", index=True)
     line_index: int
     original_text: str
     translation_text: str
@@ -47,7 +52,7 @@ class LyricsLine(SQLModel, table=True):
 
 class VocabCard(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
-    song_id: int = Field(foreign_key="song.id")
+    song_id: int = Field(foreign_key="song.id", index=True)
     
     word: str          # 單字 (如：愛してる)
     lemma: str         # 原形 (如：愛する)
@@ -58,6 +63,12 @@ class VocabCard(SQLModel, table=True):
     example_sentence: str # 例句 (原文)
     example_translation: str # 例句 (翻譯)
 
-    is_saved: bool = Field(default=False) # New field for vocabulary saving
+    is_saved: bool = Field(default=False, index=True) # New field for vocabulary saving
     
-    song: Optional[Song] = Relationship(back_populates="vocab_cards")
\ No newline at end of file
+    song: Optional[Song] = Relationship(back_populates="vocab_cards")
+
+class AnalysisCache(SQLModel, table=True):
+    # sha256 of language + stripped lyrics; raw Gemini result reused on repeat submissions
+    hash: str = Field(primary_key=True)
+    language: str = Field(primary_key=True)
+    payload_json: str
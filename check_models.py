@@ -1,4 +1,4 @@
-import google.generativeai as genai
+from google import genai
 import os
 from dotenv import load_dotenv
 
@@ -8,11 +8,11 @@ api_key = os.getenv("GOOGLE_API_KEY")
 if not api_key:
     print("GOOGLE_API_KEY not found in .env")
 else:
-    genai.configure(api_key=api_key)
+    client = genai.Client(api_key=api_key)
     try:
         print("Listing available models:")
-        for m in genai.list_models():
-            if 'generateContent' in m.supported_generation_methods:
+        for m in client.models.list():
+            if 'generateContent' in (m.supported_actions or []):
                 print(m.name)
     except Exception as e:
         print(f"Error listing models: {e}")